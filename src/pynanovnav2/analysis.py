@@ -0,0 +1,443 @@
+# Vectorized trace analysis
+#
+# Peak and notch search, -3 dB bandwidth, quality factor estimation and
+# center frequency tracking for the traces returned by _query_trace.
+#
+# All functions accept either a single trace (1-D array of nPoints values)
+# or a stack of traces (2-D array of shape (nTraces, nPoints)) that share
+# the same frequency axis. Results are returned with the leading trace
+# dimension removed again for single traces. Memory mapped arrays (for
+# example np.load(..., mmap_mode = "r")) can be passed directly;
+# analyzeResonances processes them in blocks of traces so that only a
+# small part has to be resident at any time.
+#
+# All functions require numpy.
+
+import numpy as np
+
+def _as2d(y):
+    y = np.asarray(y)
+    if y.ndim == 1:
+        return y[np.newaxis, :], True
+    if y.ndim != 2:
+        raise ValueError("Traces have to be 1-D or 2-D arrays")
+    return y, False
+
+def _squeeze(single, *values):
+    if single:
+        values = tuple(v[0] for v in values)
+    if len(values) == 1:
+        return values[0]
+    return values
+
+def findPeaks(y, nPeaks = 1, notch = False, minDistance = None, prominence = 3.0):
+    # Find the nPeaks largest local maxima (or deepest local minima for
+    # notch = True) of every trace. After a peak has been selected its
+    # neighbourhood is suppressed so ripples on top of the same resonance
+    # are not reported as further peaks. By default the neighbourhood
+    # extends to either side up to the valley after which the trace rises
+    # by more than prominence (in units of y, dB for traces in dB) again,
+    # so only peaks separated by a valley of at least that depth are
+    # reported. If minDistance is set, all bins closer than minDistance bins
+    # are suppressed instead.
+    #
+    # Returns an integer array of shape (nTraces, nPeaks) (or (nPeaks,) for a
+    # single trace) ordered by decreasing strength. Missing peaks are
+    # reported as -1.
+
+    y, single = _as2d(y)
+    nTraces, nPoints = y.shape
+    cur = -np.asarray(y, dtype = float) if notch else np.array(y, dtype = float)
+
+    # Local extrema (plateaus report their first sample)
+    isPeak = np.zeros(cur.shape, dtype = bool)
+    isPeak[:, 1:-1] = (cur[:, 1:-1] > cur[:, :-2]) & (cur[:, 1:-1] >= cur[:, 2:])
+    isPeak &= np.isfinite(cur)
+    v = np.where(isPeak, cur, -np.inf)
+    del isPeak
+
+    rows = np.arange(nTraces)
+    res = np.full((nTraces, int(nPeaks)), -1, dtype = np.int64)
+    for iPeak in range(int(nPeaks)):
+        best = np.argmax(v, axis = 1)
+        found = np.isfinite(v[rows, best])
+        res[found, iPeak] = best[found]
+        # Suppress neighbourhood of selected peak
+        for iTrace in np.nonzero(found)[0]:
+            b = int(best[iTrace])
+            if minDistance is not None:
+                md = max(int(minDistance), 1)
+                lo, hi = max(b - md + 1, 0), b + md
+            else:
+                # Walk on cur so the walk also stops at already suppressed
+                # neighbourhoods of stronger peaks
+                lo = max(_valley(cur[iTrace], b, prominence, -1), 0)
+                hi = _valley(cur[iTrace], b, prominence, 1) + 1
+            v[iTrace, lo : hi] = -np.inf
+            cur[iTrace, lo : hi] = -np.inf
+
+    return _squeeze(single, res)
+
+def interpolatePeak(freq, y, peakIdx):
+    # Parabolic sub-bin interpolation of the extremum location around
+    # peakIdx. Works for peaks as well as notches. Returns the frequency
+    # and the interpolated value with the same shape as peakIdx.
+
+    y, single = _as2d(y)
+    freq = np.asarray(freq, dtype = float)
+    peakIdx = np.asarray(peakIdx)
+    pk = peakIdx.reshape((y.shape[0], -1))
+    valid = pk >= 0
+
+    i = np.clip(pk, 1, y.shape[1] - 2)
+    rows = np.arange(y.shape[0])[:, np.newaxis]
+    ym, y0, yp = y[rows, i - 1], y[rows, i], y[rows, i + 1]
+    denom = ym - 2 * y0 + yp
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        delta = np.where(denom != 0, 0.5 * (ym - yp) / denom, 0.0)
+    delta = np.clip(delta, -0.5, 0.5)
+
+    step = freq[i + 1] - freq[i]
+    f0 = np.where(valid, freq[i] + delta * step, np.nan)
+    v0 = np.where(valid, y0 - 0.25 * (ym - yp) * delta, np.nan)
+
+    return f0.reshape(peakIdx.shape), v0.reshape(peakIdx.shape)
+
+def _crossing(row, p, th, sign, direction):
+    # Index of the first sample with sign * row < th when walking outward
+    # from p in the given direction (-1 or +1), -1 if there is none. The
+    # inspected range grows geometrically so narrow peaks only touch a few
+    # samples and no temporaries of the size of the trace are created.
+    n = row.shape[0]
+    pos = p + direction
+    w = 64
+    while 0 <= pos < n:
+        if direction > 0:
+            seg = row[pos : min(pos + w, n)]
+        else:
+            seg = row[max(pos - w + 1, 0) : pos + 1][::-1]
+        hit = (sign * seg) < th
+        k = int(np.argmax(hit))
+        if hit[k]:
+            return pos + direction * k
+        pos = pos + direction * len(seg)
+        w = w * 4
+    return -1
+
+def _valley(row, p, prominence, direction):
+    # Index of the lowest sample between p and the first sample that rises
+    # by more than prominence above the running minimum when walking outward
+    # from p in the given direction (-1 or +1). Returns -1 (or len(row))
+    # if the trace never rises again. Grows the inspected range like
+    # _crossing.
+    n = row.shape[0]
+    pos = p + direction
+    w = 64
+    runMin, iMin = np.inf, (-1 if direction < 0 else n)
+    while 0 <= pos < n:
+        if direction > 0:
+            seg = row[pos : min(pos + w, n)]
+        else:
+            seg = row[max(pos - w + 1, 0) : pos + 1][::-1]
+        m = np.fmin.accumulate(seg)
+        np.fmin(m, runMin, out = m)
+        with np.errstate(invalid = 'ignore'):
+            hit = (seg - m) > prominence
+        k = int(np.argmax(hit))
+        if hit[k]:
+            if m[k] < runMin:
+                return pos + direction * int(np.nanargmin(seg[:k + 1]))
+            return iMin
+        if m[-1] < runMin:
+            runMin, iMin = m[-1], pos + direction * int(np.nanargmin(seg))
+        pos = pos + direction * len(seg)
+        w = w * 4
+    return -1 if direction < 0 else n
+
+def notchBaseline(ydb):
+    # Off resonance level of traces containing notches, estimated as the
+    # median of every trace (in dB, one value per trace)
+    ydb, single = _as2d(ydb)
+    return _squeeze(single, np.median(ydb, axis = 1))
+
+def bandwidth(freq, ydb, peakIdx, level = 3.0, notch = False, baselineDb = None):
+    # Bandwidth of a peak measured level dB below its maximum. For notches
+    # the bandwidth is measured at half depth in linear power between the
+    # notch bottom and the off resonance level baselineDb (scalar or one
+    # value per trace, default notchBaseline) which is the full width of the
+    # underlying Lorentzian; level is ignored for notches. The crossing
+    # points are linearly interpolated between the neighbouring bins.
+    #
+    # Returns the tuple (fLow, fHigh, bw) with the same shape as peakIdx.
+    # Crossings that are not inside the trace are reported as NaN.
+
+    ydb, single = _as2d(ydb)
+    freq = np.asarray(freq, dtype = float)
+    peakIdx = np.asarray(peakIdx)
+    pk = peakIdx.reshape((ydb.shape[0], -1))
+    nTraces, nPoints = ydb.shape
+    rows = np.arange(nTraces)[:, np.newaxis]
+
+    sign = -1.0 if notch else 1.0
+    pkc = np.clip(pk, 0, nPoints - 1)
+    if notch:
+        if baselineDb is None:
+            baselineDb = np.median(ydb, axis = 1)
+        baselineDb = np.broadcast_to(np.asarray(baselineDb, dtype = float).reshape(-1), (nTraces,))[:, np.newaxis]
+        threshold = -10 * np.log10(0.5 * (np.power(10.0, baselineDb / 10.0) + np.power(10.0, ydb[rows, pkc] / 10.0)))
+    else:
+        threshold = ydb[rows, pkc] - level
+
+    fLow = np.full(pk.shape, np.nan)
+    fHigh = np.full(pk.shape, np.nan)
+
+    for iPeak in range(pk.shape[1]):
+        p = pkc[:, iPeak]
+        th = threshold[:, iPeak][:, np.newaxis]
+
+        left = np.full(nTraces, -1, dtype = np.int64)
+        right = np.full(nTraces, nPoints, dtype = np.int64)
+        for iTrace in range(nTraces):
+            if pk[iTrace, iPeak] < 0:
+                continue
+            left[iTrace] = _crossing(ydb[iTrace], int(p[iTrace]), th[iTrace, 0], sign, -1)
+            iRight = _crossing(ydb[iTrace], int(p[iTrace]), th[iTrace, 0], sign, 1)
+            right[iTrace] = iRight if iRight >= 0 else nPoints
+
+        okL = (left >= 0) & (pk[:, iPeak] >= 0)
+        okR = (right < nPoints) & (pk[:, iPeak] >= 0)
+        l0, l1 = np.clip(left, 0, nPoints - 2), np.clip(left + 1, 1, nPoints - 1)
+        r0, r1 = np.clip(right - 1, 0, nPoints - 2), np.clip(right, 1, nPoints - 1)
+
+        r = np.arange(nTraces)
+        thv = th[:, 0]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            tL = (thv - sign * ydb[r, l0]) / (sign * ydb[r, l1] - sign * ydb[r, l0])
+            tR = (thv - sign * ydb[r, r0]) / (sign * ydb[r, r1] - sign * ydb[r, r0])
+        fLow[:, iPeak] = np.where(okL, freq[l0] + tL * (freq[l1] - freq[l0]), np.nan)
+        fHigh[:, iPeak] = np.where(okR, freq[r0] + tR * (freq[r1] - freq[r0]), np.nan)
+
+    return fLow.reshape(peakIdx.shape), fHigh.reshape(peakIdx.shape), (fHigh - fLow).reshape(peakIdx.shape)
+
+def _windows(nPoints, pk, halfWidth, maxPoints = 256):
+    # Index windows around every peak. Returns the index matrix (clipped
+    # to the trace) and a mask that marks samples inside the requested (per
+    # peak) half width. Wide windows are subsampled to at most maxPoints
+    # samples per side so the window size does not grow with the trace.
+    halfWidth = np.broadcast_to(np.asarray(halfWidth, dtype = np.int64), pk.shape)
+    maxHalf = max(int(halfWidth.max()), 1) if halfWidth.size else 1
+    nSide = min(maxHalf, int(maxPoints))
+    stride = np.maximum(np.ceil(halfWidth / nSide), 1).astype(np.int64)
+    offs = np.arange(-nSide, nSide + 1) * stride[..., np.newaxis]
+    idx = pk[..., np.newaxis] + offs
+    mask = (np.abs(offs) <= halfWidth[..., np.newaxis]) & (idx >= 0) & (idx < nPoints) & (pk[..., np.newaxis] >= 0)
+    return np.clip(idx, 0, nPoints - 1), mask
+
+def fitLorentzian(freq, ydb, peakIdx, halfWidth = 50):
+    # Lorentzian fit of a resonance in power (|S|^2) around peakIdx using
+    # halfWidth bins to either side. The model
+    #
+    #   P(f) = A / (1 + (2 Q (f - f0) / f0)^2)
+    #
+    # is linearized as 1/P being quadratic in f and solved as weighted
+    # linear least squares for all traces and peaks at once (no iterations).
+    # halfWidth may be a scalar or an array with the shape of peakIdx.
+    #
+    # Returns the tuple (f0, Q, A) with the same shape as peakIdx (A in dB)
+
+    ydb, single = _as2d(ydb)
+    freq = np.asarray(freq, dtype = float)
+    peakIdx = np.asarray(peakIdx)
+    pk = peakIdx.reshape((ydb.shape[0], -1))
+    rows = np.arange(ydb.shape[0])[:, np.newaxis, np.newaxis]
+
+    idx, mask = _windows(ydb.shape[1], pk, np.asarray(halfWidth).reshape(pk.shape) if np.ndim(halfWidth) else halfWidth)
+    p = np.power(10.0, ydb[rows, idx] / 10.0)
+
+    # Center and scale frequency for numerical stability
+    fc = freq[np.clip(pk, 0, len(freq) - 1)][..., np.newaxis]
+    fs = np.maximum(np.abs(freq[idx] - fc).max(axis = -1, keepdims = True), 1e-30)
+    x = (freq[idx] - fc) / fs
+
+    mask = mask & np.isfinite(p) & (p > 0)
+    w = np.where(mask, p * p, 0.0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        z = np.where(mask, 1.0 / p, 0.0)
+
+    # Normal equations for z = a x^2 + b x + c
+    s = [ (w * x**k).sum(axis = -1) for k in range(5) ]
+    t = [ (w * z * x**k).sum(axis = -1) for k in range(3) ]
+    m = np.stack((
+        np.stack((s[4], s[3], s[2]), axis = -1),
+        np.stack((s[3], s[2], s[1]), axis = -1),
+        np.stack((s[2], s[1], s[0]), axis = -1)
+    ), axis = -2)
+    rhs = np.stack((t[2], t[1], t[0]), axis = -1)
+
+    ok = (mask.sum(axis = -1) >= 3) & (np.abs(np.linalg.det(m)) > 0)
+    m[~ok] = np.eye(3)
+    rhs[~ok] = 0
+    a, b, c = np.moveaxis(np.linalg.solve(m, rhs[..., np.newaxis])[..., 0], -1, 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        xc = -b / (2 * a)
+        zMin = c - b * b / (4 * a)
+        amp = 1.0 / zMin
+        f0 = fc[..., 0] + xc * fs[..., 0]
+        q = np.sqrt(a * amp) * f0 / (2 * fs[..., 0])
+        ampdb = 10 * np.log10(amp)
+
+    ok = ok & (a > 0) & (zMin > 0)
+    f0 = np.where(ok, f0, np.nan)
+    q = np.where(ok, q, np.nan)
+    ampdb = np.where(ok, ampdb, np.nan)
+
+    return f0.reshape(peakIdx.shape), q.reshape(peakIdx.shape), ampdb.reshape(peakIdx.shape)
+
+def fitCircle(freq, s, peakIdx, halfWidth = 50, slopeWidth = 2):
+    # Circle fit of a complex resonance (for example s01raw) around
+    # peakIdx. An algebraic (Kasa) circle fit determines the center of the
+    # resonance circle, the loaded Q is then estimated from the slope of
+    # the phase around that center at resonance
+    #
+    #   Q = f0 / 4 * |d theta / d f|
+    #
+    # with the slope determined by a linear fit over +-slopeWidth bins
+    # around the point of fastest phase rotation.
+    #
+    # Returns the tuple (f0, Q, center, radius) with the shape of peakIdx
+
+    s, single = _as2d(s)
+    freq = np.asarray(freq, dtype = float)
+    peakIdx = np.asarray(peakIdx)
+    pk = peakIdx.reshape((s.shape[0], -1))
+    rows = np.arange(s.shape[0])[:, np.newaxis, np.newaxis]
+
+    idx, mask = _windows(s.shape[1], pk, halfWidth)
+    z = s[rows, idx]
+    x, y = np.real(z), np.imag(z)
+    w = mask.astype(float)
+
+    # x^2 + y^2 + D x + E y + F = 0 (weighted linear least squares)
+    r2 = x * x + y * y
+    cols = (x, y, np.ones_like(x))
+    m = np.stack([ np.stack([ (w * ci * cj).sum(axis = -1) for cj in cols ], axis = -1) for ci in cols ], axis = -2)
+    rhs = np.stack([ -(w * r2 * ci).sum(axis = -1) for ci in cols ], axis = -1)
+    ok = (mask.sum(axis = -1) >= 3) & (np.abs(np.linalg.det(m)) > 0)
+    m[~ok] = np.eye(3)
+    rhs[~ok] = 0
+    d, e, f = np.moveaxis(np.linalg.solve(m, rhs[..., np.newaxis])[..., 0], -1, 0)
+    center = -0.5 * (d + 1j * e)
+    with np.errstate(invalid = 'ignore'):
+        radius = np.sqrt(np.abs(center)**2 - f)
+
+    # Phase around the circle center and its derivative
+    theta = np.unwrap(np.angle(z - center[..., np.newaxis]), axis = -1)
+    fw = freq[idx]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dtheta = np.abs(np.diff(theta, axis = -1) / np.diff(fw, axis = -1))
+    dtheta = np.where(mask[..., 1:] & mask[..., :-1] & np.isfinite(dtheta), dtheta, -np.inf)
+    iMax = np.argmax(dtheta, axis = -1)
+
+    # Linear fit of theta over the neighbourhood of fastest rotation
+    nWnd = idx.shape[-1]
+    offs = np.arange(-int(slopeWidth), int(slopeWidth) + 2)
+    sel = np.clip(iMax[..., np.newaxis] + offs, 0, nWnd - 1)
+    selMask = np.take_along_axis(mask, sel, axis = -1)
+    ts = np.take_along_axis(theta, sel, axis = -1)
+    fsel = np.take_along_axis(fw, sel, axis = -1)
+    wsel = selMask.astype(float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        fm = (wsel * fsel).sum(axis = -1) / wsel.sum(axis = -1)
+        tm = (wsel * ts).sum(axis = -1) / wsel.sum(axis = -1)
+        slope = (wsel * (fsel - fm[..., np.newaxis]) * (ts - tm[..., np.newaxis])).sum(axis = -1) / (wsel * (fsel - fm[..., np.newaxis])**2).sum(axis = -1)
+        f0 = 0.5 * (np.take_along_axis(fw, iMax[..., np.newaxis], axis = -1)[..., 0] + np.take_along_axis(fw, iMax[..., np.newaxis] + 1, axis = -1)[..., 0])
+        q = f0 * np.abs(slope) / 4.0
+
+    ok = ok & np.isfinite(q) & (pk >= 0)
+    f0 = np.where(ok, f0, np.nan)
+    q = np.where(ok, q, np.nan)
+    center = np.where(ok, center, np.nan)
+    radius = np.where(ok, radius, np.nan)
+
+    return f0.reshape(peakIdx.shape), q.reshape(peakIdx.shape), center.reshape(peakIdx.shape), radius.reshape(peakIdx.shape)
+
+def analyzeResonances(freq, ydb, nPeaks = 1, notch = False, minDistance = None, prominence = 3.0, level = 3.0, fit = True, fitHalfWidth = None, blockSize = 64):
+    # Complete resonance analysis for one or many traces. For every trace
+    # the nPeaks strongest peaks (or notches) are located and their center
+    # frequency (parabolic interpolation), bandwidth and Q = f0 / bw are
+    # determined (-3 dB for peaks, half depth for notches, see bandwidth).
+    # Peaks have to be separated by valleys deeper than prominence dB (or by
+    # minDistance bins if set, see findPeaks). If fit is set a Lorentzian fit is performed in addition using a
+    # window of fitHalfWidth bins (default: the measured bandwidth). Notches
+    # are fitted on their linear depth 1 - |S|^2 / baseline, "ampfit" then
+    # reports the fitted notch bottom in dB.
+    #
+    # Stacks of traces are processed in blocks of blockSize traces so memory
+    # mapped stacks are never loaded completely.
+    #
+    # Returns a dictionary of arrays of shape (nTraces, nPeaks) (or (nPeaks,))
+
+    freq = np.asarray(freq, dtype = float)
+    ydb2, single = _as2d(ydb)
+    nTraces = ydb2.shape[0]
+
+    fields = [ "index", "f0", "value", "fLow", "fHigh", "bw", "q" ]
+    if fit:
+        fields = fields + [ "f0fit", "qfit", "ampfit" ]
+    res = { }
+    for fld in fields:
+        res[fld] = np.full((nTraces, int(nPeaks)), -1 if fld == "index" else np.nan, dtype = np.int64 if fld == "index" else float)
+
+    for iStart in range(0, nTraces, int(blockSize)):
+        blk = np.asarray(ydb2[iStart : iStart + int(blockSize)], dtype = float)
+        sl = slice(iStart, iStart + blk.shape[0])
+
+        baseline = np.median(blk, axis = 1) if notch else None
+        pk = findPeaks(blk, nPeaks, notch = notch, minDistance = minDistance, prominence = prominence)
+        f0, v0 = interpolatePeak(freq, blk, pk)
+        fLow, fHigh, bw = bandwidth(freq, blk, pk, level = level, notch = notch, baselineDb = baseline)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            q = f0 / bw
+
+        res["index"][sl] = pk
+        res["f0"][sl] = f0
+        res["value"][sl] = v0
+        res["fLow"][sl] = fLow
+        res["fHigh"][sl] = fHigh
+        res["bw"][sl] = bw
+        res["q"][sl] = q
+
+        if fit:
+            if fitHalfWidth is None:
+                step = np.abs(freq[1] - freq[0]) if len(freq) > 1 else 1.0
+                hw = np.where(np.isfinite(bw), np.ceil(bw / step), 10)
+                hw = np.clip(hw, 3, blk.shape[1]).astype(np.int64)
+            else:
+                hw = fitHalfWidth
+            if notch:
+                pb = np.power(10.0, baseline / 10.0)[:, np.newaxis]
+                depth = np.maximum(1.0 - np.power(10.0, blk / 10.0) / pb, 1e-12)
+                f0fit, qfit, ampfit = fitLorentzian(freq, 10 * np.log10(depth), pk, halfWidth = hw)
+                with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                    ampfit = 10 * np.log10(pb * (1.0 - np.power(10.0, ampfit / 10.0)))
+            else:
+                f0fit, qfit, ampfit = fitLorentzian(freq, blk, pk, halfWidth = hw)
+            res["f0fit"][sl] = f0fit
+            res["qfit"][sl] = qfit
+            res["ampfit"][sl] = ampfit
+
+    if single:
+        for fld in res:
+            res[fld] = res[fld][0]
+    return res
+
+def trackCenterFrequency(freq, ydb, notch = False, useFit = False, blockSize = 64):
+    # Track the center frequency of the strongest resonance across a stack
+    # of traces (for example consecutive sweeps). Returns an array with one
+    # center frequency per trace.
+
+    res = analyzeResonances(freq, ydb, nPeaks = 1, notch = notch, fit = useFit, blockSize = blockSize)
+    if useFit:
+        return res["f0fit"][..., 0]
+    return res["f0"][..., 0]
@@ -0,0 +1,152 @@
+# Display decimation for large traces
+#
+# Full band sweeps with fine step sizes easily yield millions of points
+# per trace. Rendering those with matplotlib is slow and memory hungry
+# while a display can only show about one to two values per horizontal
+# pixel anyways. The functions in this module reduce a trace to a point
+# count appropriate for the target width while preserving peaks and
+# notches (min/max envelope) or the visual shape (LTTB, largest triangle
+# three buckets).
+#
+# All functions require numpy and operate on numpy arrays (or anything
+# that can be converted by np.asarray, including memory mapped arrays)
+
+import numpy as np
+
+def _bucketExtrema(y, nBuckets):
+    # Indices of minimum and maximum of every bucket. All buckets except
+    # the shorter last one are evaluated on a (nFull, bucketSize) reshaped
+    # view of y so no index matrix or copy of the trace is created.
+    n = y.shape[0]
+    bucketSize = int(np.ceil(n / nBuckets))
+    nFull = n // bucketSize
+
+    blocks = y[:nFull * bucketSize].reshape((nFull, bucketSize))
+    iMin = np.empty(nFull, dtype = np.int64)
+    iMax = np.empty(nFull, dtype = np.int64)
+    # numpy copies read only inputs (memory mapped traces) for argmin and
+    # argmax along an axis, chunks of rows bound the size of that copy
+    rowsPerChunk = max(65536 // bucketSize, 1)
+    for iRow in range(0, nFull, rowsPerChunk):
+        chunk = blocks[iRow : iRow + rowsPerChunk]
+        iMin[iRow : iRow + rowsPerChunk] = np.argmin(chunk, axis = 1)
+        iMax[iRow : iRow + rowsPerChunk] = np.argmax(chunk, axis = 1)
+    offsets = np.arange(nFull) * bucketSize
+    iMin += offsets
+    iMax += offsets
+
+    if nFull * bucketSize < n:
+        tail = y[nFull * bucketSize:]
+        iMin = np.append(iMin, nFull * bucketSize + np.argmin(tail))
+        iMax = np.append(iMax, nFull * bucketSize + np.argmax(tail))
+
+    return iMin, iMax
+
+def decimateMinMaxIndices(y, nPoints):
+    # Returns the (sorted) indices into y that form the min/max envelope
+    # with at most nPoints entries. Every bucket contributes its minimum
+    # and its maximum in their original order so peaks and notches are
+    # never lost.
+    y = np.asarray(y)
+    n = y.shape[0]
+    nPoints = int(nPoints)
+
+    if nPoints < 2:
+        raise ValueError("Decimation requires at least 2 output points")
+    if n <= nPoints:
+        return np.arange(n)
+
+    iMin, iMax = _bucketExtrema(y, nPoints // 2)
+
+    res = np.empty((iMin.shape[0], 2), dtype = iMin.dtype)
+    np.minimum(iMin, iMax, out = res[:,0])
+    np.maximum(iMin, iMax, out = res[:,1])
+    res = res.ravel()
+
+    # Flat buckets report the same index twice
+    keep = np.ones(res.shape[0], dtype = bool)
+    keep[1:] = res[1:] != res[:-1]
+    return res[keep]
+
+def decimateLTTBIndices(x, y, nPoints):
+    # Largest triangle three buckets. The first and last point are always
+    # kept, the remaining points are split into nPoints-2 buckets and from
+    # each bucket the point spanning the largest triangle with the previously
+    # selected point and the average of the next bucket is chosen. The loop
+    # runs over output points only, each bucket is evaluated vectorized.
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    n = y.shape[0]
+    nPoints = int(nPoints)
+
+    if nPoints < 3:
+        raise ValueError("LTTB requires at least 3 output points")
+    if n <= nPoints:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, nPoints - 1).astype(int)
+
+    # Averages of all buckets in one pass (and the last point as
+    # virtual bucket following the final real bucket)
+    cs = np.concatenate(([0.0], np.cumsum(x)))
+    csy = np.concatenate(([0.0], np.cumsum(y)))
+    counts = edges[1:] - edges[:-1]
+    avgX = np.append((cs[edges[1:]] - cs[edges[:-1]]) / counts, x[n - 1])
+    avgY = np.append((csy[edges[1:]] - csy[edges[:-1]]) / counts, y[n - 1])
+
+    res = np.empty(nPoints, dtype = np.int64)
+    res[0] = 0
+    res[nPoints - 1] = n - 1
+
+    a = 0
+    for iBucket in range(nPoints - 2):
+        lo, hi = edges[iBucket], edges[iBucket + 1]
+        bx, by = x[lo:hi], y[lo:hi]
+        cx, cy = avgX[iBucket + 1], avgY[iBucket + 1]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        res[iBucket + 1] = a
+
+    return res
+
+def decimate(x, y, nPoints = 2000, method = "minmax"):
+    # Decimate a trace to approximately nPoints points.
+    #
+    #   method "minmax"  Min/max envelope (preserves all extrema, default)
+    #   method "lttb"    Largest triangle three buckets
+    #   method "minmaxlttb" Min/max preselection to 4*nPoints followed by LTTB
+    #                    which is considerably faster for huge traces
+    #
+    # Returns the tuple (x, y) of decimated arrays
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.shape[0] != y.shape[0]:
+        raise ValueError("x and y have to be of the same length")
+
+    if method == "minmax":
+        idx = decimateMinMaxIndices(y, nPoints)
+    elif method == "lttb":
+        idx = decimateLTTBIndices(x, y, nPoints)
+    elif method == "minmaxlttb":
+        pre = decimateMinMaxIndices(y, 4 * int(nPoints))
+        idx = pre[decimateLTTBIndices(x[pre], y[pre], nPoints)]
+    else:
+        raise ValueError(f"Unknown decimation method {method}")
+
+    return x[idx], y[idx]
+
+def axesPixelWidth(ax):
+    # Width of a matplotlib axes in device pixels
+    fig = ax.get_figure()
+    return int(np.ceil(ax.get_position().width * fig.get_figwidth() * fig.dpi))
+
+def plotDecimated(ax, x, y, *args, nPoints = None, method = "minmax", **kwargs):
+    # Drop in replacement for ax.plot(x, y, ...) that decimates the trace
+    # before passing it to matplotlib. If nPoints is None two points per
+    # horizontal pixel of the axes are used, nPoints = 0 disables decimation.
+    if nPoints is None:
+        nPoints = 2 * axesPixelWidth(ax)
+    if nPoints:
+        x, y = decimate(x, y, nPoints, method)
+    return ax.plot(x, y, *args, **kwargs)
@@ -0,0 +1,205 @@
+# RF measurements derived from traces
+#
+# Return loss, VSWR, impedance, admittance, Smith chart coordinates,
+# unwrapped phase, group delay and time domain (TDR) transforms calculated
+# as whole array operations on the complex S parameters returned by
+# _query_trace (s00raw for reflection, s01raw for transmission). Note that
+# those are uncalibrated raw values unless a calibration has been applied.
+#
+# All functions operate along the last axis so stacks of traces (one trace
+# per row) are supported as well.
+#
+# The time domain transform caches its window and zero padding plan per
+# frequency grid (see tdrPlan) so repeatedly transforming sweeps of the
+# same _set_sweep_range grid costs a single FFT per sweep.
+#
+# Requires numpy
+
+import numpy as np
+
+from functools import lru_cache
+
+SPEED_OF_LIGHT = 299792458.0
+
+def returnLoss(s11):
+    # Return loss in dB (positive for passive loads)
+    with np.errstate(divide = 'ignore'):
+        return -20 * np.log10(np.absolute(s11))
+
+def insertionLoss(s21):
+    # Insertion loss in dB (positive for attenuating devices)
+    with np.errstate(divide = 'ignore'):
+        return -20 * np.log10(np.absolute(s21))
+
+def vswr(s11):
+    g = np.absolute(s11)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(g < 1, (1 + g) / (1 - g), np.inf)
+
+def impedance(s11, z0 = 50.0):
+    # Complex impedance of a load from its reflection coefficient
+    s11 = np.asarray(s11)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return z0 * (1 + s11) / (1 - s11)
+
+def admittance(s11, z0 = 50.0):
+    # Complex admittance of a load from its reflection coefficient
+    s11 = np.asarray(s11)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (1 - s11) / ((1 + s11) * z0)
+
+def smithCoordinates(s11):
+    # Cartesian coordinates on the Smith chart (the reflection coefficient
+    # itself). Returns the tuple (x, y)
+    s11 = np.asarray(s11)
+    return np.real(s11), np.imag(s11)
+
+def unwrappedPhase(s):
+    # Continuous phase in rad
+    return np.unwrap(np.angle(s), axis = -1)
+
+def groupDelay(freq, s, aperture = 1):
+    # Group delay -d phi / d omega in seconds. The derivative is taken as
+    # central difference over +-aperture points (reduced towards the ends of
+    # the trace) which smoothes noise of closely spaced points.
+    freq = np.asarray(freq, dtype = float)
+    phi = unwrappedPhase(s)
+    n = freq.shape[0]
+    aperture = int(aperture)
+    if aperture < 1:
+        raise ValueError("Group delay aperture has to be at least 1")
+    if n < 2:
+        raise ValueError("Group delay requires at least two points")
+
+    idx = np.arange(n)
+    lo = np.maximum(idx - aperture, 0)
+    hi = np.minimum(idx + aperture, n - 1)
+    return -(phi[..., hi] - phi[..., lo]) / (2 * np.pi * (freq[hi] - freq[lo]))
+
+def _window(name, n, beta):
+    if (name is None) or (name == "rect"):
+        return np.ones(n)
+    if name == "kaiser":
+        return np.kaiser(n, beta)
+    if name == "hann":
+        return np.hanning(n)
+    if name == "hamming":
+        return np.hamming(n)
+    raise ValueError(f"Unknown window {name}")
+
+@lru_cache(maxsize = 16)
+def _tdrPlanCached(fStart, fStop, nPoints, mode, window, beta, padding):
+    df = (fStop - fStart) / (nPoints - 1)
+    plan = { "mode" : mode, "nPoints" : nPoints, "df" : df }
+
+    if mode == "lowpass":
+        # The grid has to be harmonic (f_k = k * df). Bins between DC and
+        # the first measured point are extrapolated, the window is the right
+        # half of a symmetric window centered at DC.
+        k0 = int(round(fStart / df))
+        if (k0 < 1) or (abs(k0 * df - fStart) > 1e-6 * df):
+            raise ValueError("Lowpass TDR requires a harmonic frequency grid (start has to be a multiple of the step size)")
+        nBins = k0 + nPoints
+        nfft = int(padding) * 2 * (nBins - 1)
+        plan["k0"] = k0
+        plan["nBins"] = nBins
+        w = _window(window, 2 * nBins - 1, beta)[nBins - 1:]
+        # Impulse amplitude independent of window and padding, the step
+        # response is not scaled since the window is 1 at DC
+        plan["impulseScale"] = nfft / (w[0] + 2 * np.sum(w[1:]))
+        # The impulse response is symmetric around t = 0. Alternating signs
+        # shift it by nfft/2 so the time axis covers [-T/2, T/2) and the
+        # step response integrates the whole main lobe of a reflection at
+        # the reference plane
+        plan["window"] = w * (1 - 2 * (np.arange(nBins) % 2))
+        plan["time"] = (np.arange(nfft) - nfft // 2) / (nfft * df)
+        # Linear interpolation weights from DC (0) to the first point (1)
+        plan["fill"] = np.arange(k0) / k0
+    elif mode == "bandpass":
+        nfft = int(padding) * nPoints
+        w = _window(window, nPoints, beta)
+        plan["window"] = w / w.mean()
+        plan["impulseScale"] = nfft / float(nPoints)
+        plan["time"] = np.arange(nfft) / (nfft * df)
+    else:
+        raise ValueError(f"Unknown TDR mode {mode}")
+
+    plan["nfft"] = nfft
+    for fld in [ "window", "time" ]:
+        plan[fld].setflags(write = False)
+    return plan
+
+def tdrPlan(freq, mode = "lowpass", window = "kaiser", beta = 6.0, padding = 4):
+    # Window and zero padding plan for a uniform frequency grid. Plans are
+    # cached by (start, stop, number of points, settings) so the same grid
+    # reuses its plan without recomputation.
+    freq = np.asarray(freq, dtype = float)
+    if freq.ndim != 1 or freq.shape[0] < 2:
+        raise ValueError("TDR requires a 1-D frequency grid with at least two points")
+    if (int(padding) != padding) or (padding < 1):
+        raise ValueError("Zero padding factor has to be a positive integer")
+    return _tdrPlanCached(float(freq[0]), float(freq[-1]), int(freq.shape[0]), mode, window, float(beta), int(padding))
+
+def tdr(freq, s, mode = "lowpass", window = "kaiser", beta = 6.0, padding = 4, velocityFactor = 1.0, reflection = True, z0 = 50.0):
+    # Time domain transform of a reflection (or transmission) trace.
+    #
+    #   lowpass   Requires a harmonic grid. Returns impulse and step response;
+    #             for reflections additionally the step impedance profile.
+    #             The time axis is centered and covers [-T/2, T/2)
+    #   bandpass  Works on any uniform grid, returns the impulse response
+    #             (its magnitude is meaningful, the phase is not)
+    #
+    # Returns a dictionary with "time", "distance" (one way distance for
+    # reflections using velocityFactor), "impulse" and for lowpass "step"
+    # (and "impedance").
+
+    plan = tdrPlan(freq, mode, window, beta, padding)
+    s = np.asarray(s)
+    if s.shape[-1] != plan["nPoints"]:
+        raise ValueError("Trace does not match the frequency grid")
+
+    res = { "time" : plan["time"] }
+    if reflection:
+        res["distance"] = plan["time"] * SPEED_OF_LIGHT * velocityFactor / 2
+    else:
+        res["distance"] = plan["time"] * SPEED_OF_LIGHT * velocityFactor
+
+    if plan["mode"] == "lowpass":
+        k0 = plan["k0"]
+        spec = np.empty(s.shape[:-1] + (plan["nBins"],), dtype = complex)
+        spec[..., k0:] = s
+        # DC is real, estimated by linear extrapolation of the first two
+        # points. Bins between DC and the first point are interpolated.
+        dc = np.real(s[..., 0] - k0 * (s[..., 1] - s[..., 0])) if plan["nPoints"] > 1 else np.real(s[..., 0])
+        spec[..., :k0] = dc[..., np.newaxis] + plan["fill"] * (s[..., :1] - dc[..., np.newaxis])
+        spec *= plan["window"]
+
+        h = np.fft.irfft(spec, n = plan["nfft"], axis = -1)
+        res["impulse"] = h * plan["impulseScale"]
+        res["step"] = np.cumsum(h, axis = -1)
+        if reflection:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                res["impedance"] = z0 * (1 + res["step"]) / (1 - res["step"])
+    else:
+        h = np.fft.ifft(s * plan["window"], n = plan["nfft"], axis = -1)
+        res["impulse"] = h * plan["impulseScale"]
+
+    return res
+
+def measure(data, parameter = "s00raw", z0 = 50.0, groupDelayAperture = 1):
+    # All frequency domain quantities for one parameter of a _query_trace
+    # result. Reflection quantities are only calculated for s00raw.
+    s = np.asarray(data[parameter])
+    res = {
+        "phase" : unwrappedPhase(s),
+        "groupdelay" : groupDelay(data["freq"], s, groupDelayAperture)
+    }
+    if parameter == "s00raw":
+        res["returnloss"] = returnLoss(s)
+        res["vswr"] = vswr(s)
+        res["impedance"] = impedance(s, z0)
+        res["admittance"] = admittance(s, z0)
+        res["smithx"], res["smithy"] = smithCoordinates(s)
+    else:
+        res["insertionloss"] = insertionLoss(s)
+    return res
@@ -0,0 +1,197 @@
+# Baseline difference monitoring
+#
+# Continuously sweeping the same range and comparing each trace against a
+# reference usually yields traces that are nearly identical. The monitor
+# compares every segment against the baseline while the sweep is still
+# running (using the segment callback of _query_trace) and only reports the
+# frequency bins whose magnitude or phase deviation exceeds the configured
+# thresholds together with a compact summary. The size of a report thereby
+# scales with the number of changed bins instead of the sweep size.
+#
+# The baseline is either fixed (setBaseline) or a running exponential mean
+# of all previous sweeps (meanWeight).
+#
+# Requires numpy and a NanoVNAV2 instance created with useNumpy = True
+
+import numpy as np
+
+class NanoVNAV2BaselineMonitor:
+    def __init__(
+        self,
+        vna,
+
+        thresholdDb = 1.0,
+        thresholdPhase = None,
+        parameters = ( "s00raw", "s01raw" ),
+        meanWeight = None
+    ):
+        if not vna._use_numpy:
+            raise ValueError("Baseline monitoring requires a NanoVNAV2 instance using numpy")
+        if (thresholdDb is None) and (thresholdPhase is None):
+            raise ValueError("At least a magnitude or a phase threshold is required")
+        if (meanWeight is not None) and ((meanWeight <= 0) or (meanWeight > 1)):
+            raise ValueError("Running mean weight has to be in range (0, 1]")
+        for p in parameters:
+            if p not in ( "s00raw", "s01raw" ):
+                raise ValueError(f"Unsupported parameter {p} for monitoring")
+
+        self._vna = vna
+        self._thresholdDb = thresholdDb
+        self._thresholdPhase = thresholdPhase
+        self._parameters = tuple(parameters)
+        self._meanWeight = meanWeight
+
+        self._baseline = None
+        self._freq = None
+        self._sweepConfigBaseline = None
+        self._changed = None
+
+    def setBaseline(self, data = None):
+        # Use the supplied _query_trace result (or a freshly acquired trace
+        # if data is None) as reference for all following sweeps
+        if data is None:
+            data = self._vna._query_trace()
+
+        sweepConfig = self._sweepConfig()
+        if len(data["freq"]) != sweepConfig[2] * sweepConfig[3]:
+            raise ValueError("Baseline does not match the configured sweep")
+
+        self._sweepConfigBaseline = sweepConfig
+        self._freq = np.array(data["freq"])
+        self._baseline = { }
+        for p in self._parameters:
+            self._baseline[p] = np.array(data[p], dtype = complex)
+
+        return True
+
+    def _sweepConfig(self):
+        return (
+            self._vna._sweepStartHz,
+            self._vna._sweepStepHz,
+            self._vna._sweepPoints,
+            getattr(self._vna, "_sweepSegments", 1)
+        )
+
+    def clearBaseline(self):
+        self._baseline = None
+        self._freq = None
+        self._sweepConfigBaseline = None
+        return True
+
+    def _segmentCompare(self, iSegment, freqBaseIndex, newpkgdata):
+        nPoints = len(newpkgdata["freq"])
+        sl = slice(freqBaseIndex, freqBaseIndex + nPoints)
+
+        changed = np.zeros(nPoints, dtype = bool)
+        deltas = { }
+        for p in self._parameters:
+            ref = self._baseline[p][sl]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                ratio = newpkgdata[p] / ref
+                ddb = 20 * np.log10(np.absolute(ratio))
+            dph = np.angle(ratio)
+
+            if self._thresholdDb is not None:
+                changed |= np.absolute(ddb) >= self._thresholdDb
+            if self._thresholdPhase is not None:
+                changed |= np.absolute(dph) >= self._thresholdPhase
+            deltas[p] = ( ddb, dph )
+
+            if self._meanWeight is not None:
+                ref += self._meanWeight * (newpkgdata[p] - ref)
+
+        idx = np.nonzero(changed)[0]
+        self._changed["index"].append(idx + freqBaseIndex)
+        self._changed["freq"].append(np.asarray(newpkgdata["freq"])[idx])
+        for p in self._parameters:
+            self._changed[p].append(newpkgdata[p][idx])
+            self._changed[p + "deltadb"].append(deltas[p][0][idx])
+            self._changed[p + "deltaphase"].append(deltas[p][1][idx])
+
+            # Summary statistics over the whole trace are accumulated per segment
+            ddb = deltas[p][0][np.isfinite(deltas[p][0])]
+            self._summary[p]["sumsqdb"] += float(np.sum(ddb * ddb))
+            self._summary[p]["ndb"] += len(ddb)
+            if len(ddb) > 0:
+                self._summary[p]["maxdb"] = max(self._summary[p]["maxdb"], float(np.max(np.absolute(ddb))))
+            if nPoints > 0:
+                self._summary[p]["maxphase"] = max(self._summary[p]["maxphase"], float(np.max(np.absolute(deltas[p][1]))))
+
+    def sweep(self):
+        # Perform one sweep and return the deviation report:
+        #
+        #   index, freq            Changed bins (indices into the full trace)
+        #   <param>                Measured complex values at the changed bins
+        #   <param>deltadb         Magnitude deviation from baseline in dB
+        #   <param>deltaphase      Phase deviation from baseline in rad
+        #   segments               (firstIndex, lastIndex) of contiguous runs
+        #   summary                Number of points, changed bins and per
+        #                          parameter maximum and RMS deviation
+        #
+        # The very first sweep without baseline becomes the baseline and
+        # reports no changes.
+
+        if self._baseline is None:
+            data = self._vna._query_trace()
+            self.setBaseline(data)
+            nPoints = len(self._freq)
+            self._changed = None
+            return self._emptyReport(nPoints)
+
+        # Check before sweeping, comparing segments against a baseline of
+        # a different sweep would fail midway or silently compare against
+        # wrong frequencies
+        if self._sweepConfig() != self._sweepConfigBaseline:
+            raise ValueError("Configured sweep does not match the baseline, sweep range changed?")
+
+        self._changed = { "index" : [], "freq" : [] }
+        self._summary = { }
+        for p in self._parameters:
+            self._changed[p] = []
+            self._changed[p + "deltadb"] = []
+            self._changed[p + "deltaphase"] = []
+            self._summary[p] = { "maxdb" : 0.0, "maxphase" : 0.0, "sumsqdb" : 0.0, "ndb" : 0 }
+
+        data = self._vna._query_trace(segmentCallback = self._segmentCompare)
+        nPoints = len(data["freq"])
+        if nPoints != len(self._freq):
+            raise ValueError("Sweep does not match the baseline, sweep range changed?")
+
+        report = { }
+        for fld in self._changed:
+            report[fld] = np.concatenate(self._changed[fld])
+        report["segments"] = self._runs(report["index"])
+
+        report["summary"] = { "points" : nPoints, "changed" : len(report["index"]) }
+        for p in self._parameters:
+            s = self._summary[p]
+            report["summary"][p] = {
+                "maxdeltadb" : s["maxdb"],
+                "rmsdeltadb" : float(np.sqrt(s["sumsqdb"] / s["ndb"])) if s["ndb"] > 0 else 0.0,
+                "maxdeltaphase" : s["maxphase"]
+            }
+
+        self._changed = None
+        return report
+
+    def _emptyReport(self, nPoints):
+        report = { "index" : np.zeros(0, dtype = np.int64), "freq" : np.zeros(0) }
+        for p in self._parameters:
+            report[p] = np.zeros(0, dtype = complex)
+            report[p + "deltadb"] = np.zeros(0)
+            report[p + "deltaphase"] = np.zeros(0)
+        report["segments"] = np.zeros((0, 2), dtype = np.int64)
+        report["summary"] = { "points" : nPoints, "changed" : 0 }
+        for p in self._parameters:
+            report["summary"][p] = { "maxdeltadb" : 0.0, "rmsdeltadb" : 0.0, "maxdeltaphase" : 0.0 }
+        return report
+
+    @staticmethod
+    def _runs(idx):
+        # Contiguous runs of bin indices as (first, last) pairs
+        if len(idx) == 0:
+            return np.zeros((0, 2), dtype = np.int64)
+        breaks = np.nonzero(np.diff(idx) != 1)[0]
+        first = np.concatenate(([idx[0]], idx[breaks + 1]))
+        last = np.concatenate((idx[breaks], [idx[-1]]))
+        return np.stack((first, last), axis = 1)
@@ -5,6 +5,11 @@ import serial
 import atexit
 import struct
 import math
+import time
+import os
+import json
+import threading
+import queue
 
 import logging
 
@@ -94,6 +99,13 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
         self._hardwareRevision = None
         self._firmwareVersion = ( None, None )
         self._frequencies = None
+        self._cwFrequencyHz = None
+        self._cwPoints = None
+        self._cwValuesPerFrequency = None
+        self._sweepPlan = None
+        self._postprocessor = None
+        self._segmentRetries = 3
+        self._pipelineStats = None
 
         if isinstance(port, serial.Serial):
             self._port = port
@@ -140,6 +152,12 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
             self._port.close()
             self._port = None
 
+        # Shut down the post processing thread pool, processing falls back
+        # to the single threaded path afterwards
+        if self._postprocessor is not None:
+            self._postprocessor.close()
+            self._postprocessor = None
+
     # Connect and disconnect
 
     def _connect(self):
@@ -222,7 +240,10 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
             raise CommunicationError_NotConnected("Device is not connected")
 
         self._port.write(struct.pack('<B', 0x0D ))
-        resp = struct.unpack('<B', self._port.read(1))[0]
+        dta = self._port.read(1)
+        if len(dta) != 1:
+            raise CommunicationError_Timeout("Device did not answer indicate")
+        resp = struct.unpack('<B', dta)[0]
 
         return resp
 
@@ -368,6 +389,227 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
 
         return True
 
+    def _fifo_read(self, nRecords, inflight = False):
+        # Read nRecords 32 byte records from the values FIFO. The device
+        # delivers at most 255 records per request so larger reads are
+        # split into multiple requests. With inflight set all requests are
+        # issued at once and the device processes them back to back while
+        # the host is still receiving the first batch.
+
+        nBatches = (nRecords + 254) // 255
+        batchSizes = [ min(nRecords - i * 255, 255) for i in range(nBatches) ]
+
+        alldata = bytearray()
+        if inflight:
+            self._port.write(b''.join([ struct.pack('<BBB', 0x18, 0x30, batchPoints) for batchPoints in batchSizes ]))
+        for batchPoints in batchSizes:
+            if not inflight:
+                self._port.write(struct.pack('<BBB', 0x18, 0x30, batchPoints))
+            self._fifo_receive(batchPoints, alldata)
+
+        return bytes(alldata)
+
+    def _fifo_receive(self, nRecords, alldata):
+        # Append nRecords already requested FIFO records to the bytearray
+        # alldata
+        nBytesToRead = len(alldata) + 32 * nRecords
+        while len(alldata) < nBytesToRead:
+            datanew = self._port.read(nBytesToRead - len(alldata))
+            if not datanew:
+                raise CommunicationError_Timeout("Failed to receive FIFO data")
+            alldata.extend(datanew)
+        return alldata
+
+    def _fifo_check(self, alldata, points):
+        # Raise a protocol violation if any record reports a frequency index
+        # outside of a sweep window of the given number of points
+        if self._use_numpy:
+            import numpy as np
+            outside = np.any(np.frombuffer(alldata, dtype = '<u2')[12::16] >= points)
+        else:
+            outside = any([ rec[0] >= points for rec in struct.iter_unpack('<24xH6x', alldata) ])
+        if outside:
+            raise CommunicationError_ProtocolViolation("Received FIFO record outside of sweep window")
+
+    def _resync(self):
+        # Bring the protocol back into a known state after a failed
+        # transfer: terminate lingering commands with no-operation bytes,
+        # drop everything that is still arriving and check that the device
+        # answers the indicate opcode again
+        for i in range(64):
+            self._op_nop()
+
+        oldTimeout = self._port.timeout
+        self._port.timeout = 0.1
+        try:
+            while True:
+                dta = self._port.read(1024)
+                if not dta:
+                    break
+        finally:
+            self._port.timeout = oldTimeout
+
+        indicateResult = self._op_indicate()
+        if indicateResult != 0x32:
+            raise CommunicationError_ProtocolViolation(f"Would expect device to report version 2 (0x32, 50) after resync, received {indicateResult}")
+
+    def _set_segment_retries(self, retries):
+        if (int(retries) != retries) or (retries < 0):
+            raise ValueError("Number of retries has to be a non negative integer")
+        self._segmentRetries = int(retries)
+        return True
+
+    def _acquire_segment(self, start, step, points, valuesPerFrequency, inflight = False):
+        # Program a single sweep window, clear the FIFO and read all
+        # records. Short reads, timeouts and records with frequency indices
+        # outside of the window are retried (after resync) up to
+        # _segmentRetries times. A failing resync counts as failed attempt
+        # as well. Returns the raw FIFO records.
+
+        nRecords = int(points) * int(valuesPerFrequency)
+        for iTry in range(self._segmentRetries + 1):
+            try:
+                if iTry > 0:
+                    self._resync()
+
+                self._reg_write(0x00, int(start))
+                self._reg_write(0x10, int(step))
+                self._reg_write(0x20, int(points))
+                self._reg_write(0x22, int(valuesPerFrequency))
+
+                # Clear FIFO ...
+                self._port.write(struct.pack('<BBB', 0x20, 0x30, 0x00))
+
+                alldata = self._fifo_read(nRecords, inflight)
+                self._fifo_check(alldata, points)
+                return alldata
+            except (CommunicationError_Timeout, CommunicationError_ProtocolViolation) as e:
+                if iTry >= self._segmentRetries:
+                    raise
+                self._logger.warning(f"Segment at {start} Hz failed ({e}), retrying ({iTry + 1} of {self._segmentRetries})")
+
+    def _segment_commands(self, start, step, points, valuesPerFrequency):
+        # Command sequence programming one sweep window, clearing the FIFO
+        # and requesting all of its records as a single write
+        nRecords = int(points) * int(valuesPerFrequency)
+        cmds = [
+            struct.pack('<BBQ', 0x23, 0x00, int(start)),
+            struct.pack('<BBQ', 0x23, 0x10, int(step)),
+            struct.pack('<BBH', 0x21, 0x20, int(points)),
+            struct.pack('<BBH', 0x21, 0x22, int(valuesPerFrequency)),
+            struct.pack('<BBB', 0x20, 0x30, 0x00)
+        ]
+        for i in range(0, nRecords, 255):
+            cmds.append(struct.pack('<BBB', 0x18, 0x30, min(nRecords - i, 255)))
+        return b''.join(cmds)
+
+    def _segment_receive(self, points, valuesPerFrequency):
+        # Receive the records of a window requested by _segment_commands
+        alldata = bytes(self._fifo_receive(int(points) * int(valuesPerFrequency), bytearray()))
+        self._fifo_check(alldata, points)
+        return alldata
+
+    def _checkpoint_header(self):
+        return {
+            "sweepStartHz" : int(self._sweepStartHz),
+            "sweepStepHz" : int(self._sweepStepHz),
+            "sweepPoints" : int(self._sweepPoints),
+            "sweepSegments" : int(self._sweepSegments),
+            "valuesPerFrequency" : int(self._valuesPerFrequency),
+            "discardFirstPoint" : self._discard_first_point
+        }
+
+    def _checkpoint_open(self, checkpoint):
+        # Open (or create) a checkpoint. The sweep configuration is stored
+        # in a JSON sidecar file, the raw records of all completed segments
+        # are appended to the checkpoint itself. Returns the list of raw
+        # records of already completed segments.
+        header = self._checkpoint_header()
+        realSweepPoints = self._sweepPoints + (1 if self._discard_first_point else 0)
+        segmentBytes = 32 * realSweepPoints * self._valuesPerFrequency
+
+        segments = []
+        if os.path.exists(checkpoint + ".json") and os.path.exists(checkpoint):
+            with open(checkpoint + ".json", "r") as f:
+                if json.load(f) != header:
+                    raise ValueError(f"Checkpoint {checkpoint} does not match the configured sweep")
+            with open(checkpoint, "rb") as f:
+                dta = f.read()
+            nComplete = min(len(dta) // segmentBytes, self._sweepSegments)
+            segments = [ dta[i * segmentBytes : (i + 1) * segmentBytes] for i in range(nComplete) ]
+
+            # Drop a partially written trailing segment
+            with open(checkpoint, "r+b") as f:
+                f.truncate(nComplete * segmentBytes)
+            self._logger.info(f"Resuming sweep from checkpoint {checkpoint} at segment {nComplete} of {self._sweepSegments}")
+        else:
+            with open(checkpoint + ".json", "w") as f:
+                json.dump(header, f)
+            open(checkpoint, "wb").close()
+
+        return segments
+
+    def _checkpoint_append(self, checkpoint, alldata):
+        with open(checkpoint, "ab") as f:
+            f.write(alldata)
+
+    def _checkpoint_remove(self, checkpoint):
+        for fn in [ checkpoint, checkpoint + ".json" ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def _fifo_decode(self, alldata):
+        # Vectorized decoding of FIFO records (requires numpy). Returns
+        # the frequency indices as well as the complex fwd0, rev0 and rev1
+        # values of all records
+        import numpy as np
+
+        records = np.frombuffer(alldata, dtype = np.dtype([
+            ("fwd0", "<i4", (2,)), ("rev0", "<i4", (2,)), ("rev1", "<i4", (2,)),
+            ("freqIndex", "<u2"), ("reserved0", "<u2"), ("reserved1", "<u4")
+        ]))
+
+        return {
+            "freqIndex" : records["freqIndex"].astype(np.int64),
+            "fwd0" : records["fwd0"][:,0] + 1j * records["fwd0"][:,1],
+            "rev0" : records["rev0"][:,0] + 1j * records["rev0"][:,1],
+            "rev1" : records["rev1"][:,0] + 1j * records["rev1"][:,1]
+        }
+
+    def _set_postprocessing(self, threads = None, chunkSize = 65536, fused = True, corrections = None):
+        # Configure chunked (and for threads > 1 parallel) derivation of
+        # S parameters, magnitudes and phases at the end of every query (see
+        # TracePostProcessor). Passing threads = 0 restores the default
+        # single pass implementation.
+        if self._postprocessor is not None:
+            self._postprocessor.close()
+            self._postprocessor = None
+
+        if threads == 0:
+            return True
+        if not self._use_numpy:
+            raise ValueError("Post processing requires numpy")
+
+        from pynanovnav2.postprocess import TracePostProcessor
+        self._postprocessor = TracePostProcessor(threads = threads, chunkSize = chunkSize, fused = fused, corrections = corrections)
+        return True
+
+    def _derive_quantities(self, pkgdata):
+        # Derive raw S parameters, their magnitude in dB and phase from the
+        # fwd0, rev0 and rev1 arrays
+        if self._postprocessor is not None:
+            return self._postprocessor.process(pkgdata)
+
+        import numpy as np
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            pkgdata["s00raw"] = pkgdata["rev0"] / pkgdata["fwd0"]
+            pkgdata["s01raw"] = pkgdata["rev1"] / pkgdata["fwd0"]
+            pkgdata["s00rawdbm"] = np.log10(np.absolute(pkgdata["s00raw"])) * 20
+            pkgdata["s01rawdbm"] = np.log10(np.absolute(pkgdata["s01raw"])) * 20
+        pkgdata["s00rawphase"] = np.angle(pkgdata["s00raw"])
+        pkgdata["s01rawphase"] = np.angle(pkgdata["s01raw"])
+        return pkgdata
+
     def __complex_divide(self, a, b):
         # Perform complex number division
         #
@@ -381,10 +623,25 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
             a[1] * b[0] + a[0] * b[1] / (b[0] * b[0] + b[1] * b[1])
         )
 
-    def _query_trace(self):
+    def _query_trace(self, segmentCallback = None, checkpoint = None):
+        # Query the configured sweep segment by segment. If a segmentCallback
+        # is supplied it's called as segmentCallback(iSegment, freqBaseIndex, newpkgdata)
+        # after every decoded segment so consumers can process data while
+        # the remaining segments are still being acquired
+        #
+        # If a checkpoint filename is supplied the raw data of every completed
+        # segment is appended to that file. When a sweep is interrupted
+        # (for example when all retries of a segment failed) calling
+        # _query_trace again with the same checkpoint resumes at the first
+        # missing segment. The checkpoint is removed after a successful sweep.
+
         if self._port is None:
             raise CommunicationError_NotConnected("Device it not connected, failed to query data")
 
+        checkpointSegments = []
+        if checkpoint is not None:
+            checkpointSegments = self._checkpoint_open(checkpoint)
+
         currentStart = self._sweepStartHz
 #        currentValuesPerFreq = self._valuesPerFrequency
         freqBaseIndex = 0
@@ -396,10 +653,9 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
 
                 "fwd0" : np.asarray([]), # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex),
                 "rev0" : np.asarray([]), # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex),
-                "rev1" : np.asarray([]), # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex),
+                "rev1" : np.asarray([])  # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex),
 
-                "s00raw" : np.asarray([]), # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex),
-                "s01raw" : np.asarray([])  # np.full((self._sweepPoints * self._sweepSegments), np.nan, dtype = complex)
+                # s00raw and s01raw are derived from the merged trace by _derive_quantities
             }
         else:
             pkgdata = {
@@ -434,35 +690,15 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
             if self._discard_first_point:
                 realSweepPoints = realSweepPoints + 1
 
-            self._reg_write(0x00, int(currentStart))
-            self._reg_write(0x10, int(self._sweepStepHz))
-            self._reg_write(0x20, realSweepPoints)
-            self._reg_write(0x22, int(self._valuesPerFrequency))
-
-            # Clear FIFO ...
-            self._port.write(struct.pack('<BBB', 0x20, 0x30, 0x00))
-
-            # Read data ...
+            # Read data (or restore from checkpoint) ...
             nPointsToRead = self._valuesPerFrequency * realSweepPoints
             nDataPoints = nPointsToRead
-            while nPointsToRead > 0:
-                batchPoints = min(nPointsToRead, 255)
-                self._port.write(struct.pack('<BBB', 0x18, 0x30, batchPoints))
-                nBytesToRead = 32 * batchPoints
-                nBytesRead = 0
-                alldata = None
-                while (alldata is None) or (nBytesRead < nBytesToRead):
-                    datanew = self._port.read(nBytesToRead - nBytesRead)
-                    if datanew is None:
-                        raise CommunicationError_Timeout("Failed to receive FIFO data")
-                    if alldata is not None:
-                        alldata = alldata + datanew
-                    else:
-                        alldata = datanew
-
-                    nBytesRead = nBytesRead + len(datanew)
-
-                nPointsToRead = nPointsToRead - batchPoints
+            if iSegment < len(checkpointSegments):
+                alldata = checkpointSegments[iSegment]
+            else:
+                alldata = self._acquire_segment(currentStart, self._sweepStepHz, realSweepPoints, self._valuesPerFrequency)
+                if checkpoint is not None:
+                    self._checkpoint_append(checkpoint, alldata)
 
             # If we have to discard the first data point - drop ...
             if self._discard_first_point:
@@ -477,10 +713,7 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
 
                     "fwd0" : np.full((nDataPoints), np.nan, dtype = complex),
                     "rev0" : np.full((nDataPoints), np.nan, dtype = complex),
-                    "rev1" : np.full((nDataPoints), np.nan, dtype = complex),
-
-                    "s00raw" : np.full((nDataPoints), np.nan, dtype = complex),
-                    "s01raw" : np.full((nDataPoints), np.nan, dtype = complex)
+                    "rev1" : np.full((nDataPoints), np.nan, dtype = complex)
                 }
             else:
                 newpkgdata = {
@@ -519,16 +752,22 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
                 # Recover uncalibrated raw data for S parameters by taking into account
                 # transmitted signal amplitude and phase
 
+                # (with numpy this is done on whole arrays)
+
                 if not self._use_numpy:
                     newpkgdata["s00raw"][freqIndex] = self.__complex_divide( (rev0Re, rev0Im), (fwd0Re, fwd0Im) )
                     newpkgdata["s01raw"][freqIndex] = self.__complex_divide( (rev1Re, rev1Im), (fwd0Re, fwd0Im) )
-                else:
-                    newpkgdata["s00raw"][freqIndex] = newpkgdata["rev0"][freqIndex] / newpkgdata["fwd0"][freqIndex]
-                    newpkgdata["s01raw"][freqIndex] = newpkgdata["rev1"][freqIndex] / newpkgdata["fwd0"][freqIndex]
+
+            if segmentCallback is not None:
+                if self._use_numpy:
+                    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                        newpkgdata["s00raw"] = newpkgdata["rev0"] / newpkgdata["fwd0"]
+                        newpkgdata["s01raw"] = newpkgdata["rev1"] / newpkgdata["fwd0"]
+                segmentCallback(iSegment, freqBaseIndex, newpkgdata)
 
             # Merge to global packet data ...
             if self._use_numpy:
-                for fld in [ "freq", "fwd0", "rev0", "rev1", "s00raw", "s01raw" ]:
+                for fld in [ "freq", "fwd0", "rev0", "rev1" ]:
                     pkgdata[fld] = np.concatenate((pkgdata[fld], newpkgdata[fld]))
             else:
                 for fld in [ "freq", "fwd0", "rev0", "rev1", "s00raw", "s01raw" ]:
@@ -541,17 +780,575 @@ class NanoVNAV2(vectornetworkanalyzer.VectorNetworkAnalyzer):
             if self._discard_first_point:
                 currentStart = currentStart - self._sweepStepHz
 
+        if checkpoint is not None:
+            self._checkpoint_remove(checkpoint)
+
         if self._use_numpy:
-            pkgdata["s00rawdbm"] = np.log10(np.absolute(pkgdata["s00raw"])) * 20
-            pkgdata["s01rawdbm"] = np.log10(np.absolute(pkgdata["s01raw"])) * 20
-            pkgdata["s00rawphase"] = np.angle(pkgdata["s00raw"])
-            pkgdata["s01rawphase"] = np.angle(pkgdata["s01raw"])
+            self._derive_quantities(pkgdata)
         else:
             #ToDo ... without numpy ...
             pass
 
         return pkgdata
 
+    # Zero span (CW) acquisition
+    #
+    # The device is programmed with a step size of 0 Hz so every point of
+    # the sweep window is measured at the same frequency. Since the
+    # frequency never changes there is no need to discard the first point of
+    # a window and the FIFO can be drained continuously without reprogramming
+    # between batches.
+
+    def _set_cw(self, frequency, points = 1024, valuesPerFrequency = 1):
+        if int(frequency) != frequency:
+            raise ValueError("CW frequency has to be an integer value")
+        if (float(frequency) < self._frequencyRange[0]) or (float(frequency) > self._frequencyRange[1]):
+            raise ValueError(f"CW frequency has to be in range {self._frequencyRange[0]} to {self._frequencyRange[1]} Hz")
+        if (int(points) != points) or (points < 1) or (points > 65535):
+            raise ValueError("Number of points per window has to be an integer from 1 to 65535")
+        if (int(valuesPerFrequency) != valuesPerFrequency) or (valuesPerFrequency < 1) or (valuesPerFrequency > 65535):
+            raise ValueError("Values per frequency has to be an integer from 1 to 65535")
+        if self._port is None:
+            raise CommunicationError_NotConnected("Device is not connected")
+
+        self._reg_write(0x00, int(frequency))
+        self._reg_write(0x10, 0)
+        self._reg_write(0x20, int(points))
+        self._reg_write(0x22, int(valuesPerFrequency))
+
+        self._cwFrequencyHz = int(frequency)
+        self._cwPoints = int(points)
+        self._cwValuesPerFrequency = int(valuesPerFrequency)
+
+        return True
+
+    def _query_cw(self, nSamples, duration = None, batchCallback = None):
+        # Stream CW samples from the FIFO into preallocated arrays.
+        #
+        # Without duration exactly nSamples samples are acquired. With a
+        # duration (in seconds) the arrays are used as ring buffer of nSamples
+        # entries that is filled until the duration has elapsed; the returned
+        # arrays contain the most recent samples in chronological order.
+        #
+        # Sample timestamps (time.monotonic based, relative to the start of
+        # the acquisition) are interpolated linearly between the arrival of
+        # consecutive FIFO batches. Gaps in the device point counter (FIFO
+        # overruns) are counted in "lost" (only possible with one value per
+        # frequency, None otherwise).
+        #
+        # If a batchCallback is supplied it's called as batchCallback(nTotal, newdata)
+        # for every received batch with nTotal being the number of samples
+        # received before that batch.
+
+        if self._port is None:
+            raise CommunicationError_NotConnected("Device it not connected, failed to query data")
+        if self._cwFrequencyHz is None:
+            raise ValueError("CW mode has not been configured, use _set_cw first")
+        if not self._use_numpy:
+            raise ValueError("CW acquisition requires numpy")
+        if (int(nSamples) != nSamples) or (nSamples < 1):
+            raise ValueError("Number of samples has to be a positive integer")
+
+        import numpy as np
+
+        nSamples = int(nSamples)
+        pkgdata = {
+            "time" : np.full((nSamples), np.nan),
+            "fwd0" : np.full((nSamples), np.nan, dtype = complex),
+            "rev0" : np.full((nSamples), np.nan, dtype = complex),
+            "rev1" : np.full((nSamples), np.nan, dtype = complex)
+        }
+        # Clear FIFO ...
+        self._port.write(struct.pack('<BBB', 0x20, 0x30, 0x00))
+
+        nTotal = 0
+        nLost = 0
+        lastFreqIndex = None
+        tStart = time.monotonic()
+        tLast = tStart
+
+        while True:
+            if duration is None:
+                if nTotal >= nSamples:
+                    break
+                batchPoints = min(nSamples - nTotal, 255)
+            else:
+                if (tLast - tStart) >= duration:
+                    break
+                batchPoints = 255
+
+            records = self._fifo_decode(self._fifo_read(batchPoints))
+            tNow = time.monotonic()
+
+            if self._cwValuesPerFrequency == 1:
+                freqIndex = records["freqIndex"]
+                if lastFreqIndex is not None:
+                    freqIndex = np.concatenate(([lastFreqIndex], freqIndex))
+                nLost = nLost + int(np.sum((np.diff(freqIndex) - 1) % self._cwPoints))
+                lastFreqIndex = int(freqIndex[-1])
+            else:
+                nLost = None
+
+            newdata = {
+                "time" : np.linspace(tLast - tStart, tNow - tStart, batchPoints + 1)[1:],
+                "fwd0" : records["fwd0"],
+                "rev0" : records["rev0"],
+                "rev1" : records["rev1"]
+            }
+
+            if batchCallback is not None:
+                batchCallback(nTotal, newdata)
+
+            # Store into (ring) buffer
+            dst = (nTotal + np.arange(batchPoints)) % nSamples
+            for fld in [ "time", "fwd0", "rev0", "rev1" ]:
+                pkgdata[fld][dst] = newdata[fld]
+
+            nTotal = nTotal + batchPoints
+            tLast = tNow
+
+        if nTotal > nSamples:
+            for fld in [ "time", "fwd0", "rev0", "rev1" ]:
+                pkgdata[fld] = np.roll(pkgdata[fld], -(nTotal % nSamples))
+        elif nTotal < nSamples:
+            for fld in [ "time", "fwd0", "rev0", "rev1" ]:
+                pkgdata[fld] = pkgdata[fld][:nTotal]
+
+        pkgdata["freq"] = self._cwFrequencyHz
+        self._derive_quantities(pkgdata)
+
+        pkgdata["count"] = nTotal
+        pkgdata["lost"] = nLost
+        pkgdata["duration"] = tLast - tStart
+        pkgdata["samplerate"] = nTotal / (tLast - tStart) if tLast > tStart else 0.0
+
+        return pkgdata
+
+    # Multi band and frequency list sweeps
+    #
+    # A sweep plan is an arbitrary sorted list of frequencies (for example
+    # the union of several bands with individual step sizes). It's compiled
+    # into hardware segments greedily: every segment starts at the lowest
+    # frequency not covered yet and uses the step size (out of the spacings
+    # to the following points and their common divisors) whose grid covers
+    # the most remaining frequencies within one window. Grid points that
+    # are not requested are measured and dropped, frequencies between grid
+    # points are left for later segments. This usually needs far fewer
+    # segments than splitting at every change of spacing but is not
+    # guaranteed to be minimal. All segments are then acquired in a single
+    # call into one preallocated trace.
+
+    def _set_sweep_bands(self, bands):
+        # bands is a list of (start, stop, step) tuples, stop is inclusive
+        # if it's located on the step grid. Overlapping bands are merged,
+        # each frequency is assigned to the first band that contains it.
+        import numpy as np
+
+        if len(bands) < 1:
+            raise ValueError("At least one band is required")
+
+        freqs, bandIdx = [], []
+        for iBand, band in enumerate(bands):
+            if len(band) != 3:
+                raise ValueError("Bands have to be (start, stop, step) tuples")
+            start, stop, step = band
+            if (int(start) != start) or (int(stop) != stop) or (int(step) != step):
+                raise ValueError("Band start, stop and step have to be integer values")
+            if (step < self._frequencyStepRange[0]) or (step > self._frequencyStepRange[1]):
+                raise ValueError(f"Step size has to be in range {self._frequencyStepRange[0]} to {self._frequencyStepRange[1]} Hz")
+            if stop < start:
+                raise ValueError("Stop frequency has to be above start frequency")
+            nPoints = int((int(stop) - int(start)) // int(step)) + 1
+            freqs.append(int(start) + np.arange(nPoints, dtype = np.int64) * int(step))
+            bandIdx.append(np.full(nPoints, iBand, dtype = np.int64))
+
+        freqs, first = np.unique(np.concatenate(freqs), return_index = True)
+        return self._set_sweep_plan(freqs, np.concatenate(bandIdx)[first])
+
+    def _set_sweep_frequencies(self, frequencies):
+        # Explicit list of frequencies in Hz (duplicates are removed,
+        # the list is sorted). All points are reported as band 0.
+        import numpy as np
+
+        frequencies = np.asarray(frequencies)
+        if frequencies.ndim != 1 or len(frequencies) < 1:
+            raise ValueError("Frequency list has to be a non empty 1-D list")
+        if np.any(np.floor(frequencies) != frequencies):
+            raise ValueError("Frequencies have to be integer values")
+
+        freqs = np.unique(frequencies.astype(np.int64))
+        return self._set_sweep_plan(freqs, np.zeros(len(freqs), dtype = np.int64))
+
+    def _compile_sweep_runs(self, freqs, d, wndPoints, minStep, maxStep):
+        # Split the sorted frequencies at every change of spacing, each run
+        # of equally spaced points is covered by consecutive windows
+        import numpy as np
+
+        # For every diff the (exclusive) end of its run of equal diffs
+        runStarts = np.concatenate(([0], np.nonzero(d[1:] != d[:-1])[0] + 1))
+        runEnds = np.concatenate((runStarts[1:], [len(d)]))
+        runEnd = np.repeat(runEnds, runEnds - runStarts)
+
+        segments = []
+        i, n = 0, len(freqs)
+        while i < n:
+            if (i == n - 1) or (d[i] > maxStep):
+                # Isolated point, the step size is irrelevant
+                step, count = minStep, 1
+            else:
+                step = int(d[i])
+                count = min(int(runEnd[i]) - i + 1, wndPoints)
+            segments.append(( int(freqs[i]), step, count, np.arange(i, i + count) ))
+            i = i + count
+
+        return segments
+
+    def _compile_sweep_grids(self, freqs, d, wndPoints, minStep, maxStep, nCandidates = 16, nScan = None):
+        # Start every window at the lowest uncovered frequency and choose
+        # the step size whose grid covers the most uncovered frequencies.
+        # Candidate steps are the spacings to the following nCandidates
+        # uncovered points and their common divisors, evaluated against the
+        # next nScan (default 4 windows) requested points. Requested points
+        # between the grid points are left for later windows. Both limits
+        # bound the work per window so dense arbitrary lists compile in time
+        # linear in their length; grids whose points are spread wider than
+        # that are not found.
+        import numpy as np
+
+        fMin = self._frequencyRange[0]
+        if nScan is None:
+            nScan = 4 * wndPoints
+
+        segments = []
+        covered = np.zeros(len(freqs), dtype = bool)
+        i, n = 0, len(freqs)
+        while i < n:
+            fi = int(freqs[i])
+            best = None
+
+            # Fast path: a full window of equally spaced uncovered points
+            # can not be improved on
+            if i + wndPoints <= n:
+                dw = d[i : i + wndPoints - 1]
+                if (dw[0] <= maxStep) and np.all(dw == dw[0]) and not np.any(covered[i : i + wndPoints]):
+                    best = ( int(dw[0]), np.arange(i, i + wndPoints), np.arange(wndPoints) )
+
+            if best is None:
+                hiIdx = min(int(np.searchsorted(freqs, fi + (wndPoints - 1) * maxStep, side = 'right')), i + 1 + nScan)
+                uncovered = i + 1 + np.flatnonzero(~covered[i + 1 : hiIdx])
+                rel = freqs[uncovered] - fi
+
+                diffs = rel[:nCandidates]
+                steps = [ diffs ]
+                if len(diffs) > 1:
+                    steps.append(np.gcd.accumulate(diffs))
+                    steps.append(np.gcd(diffs[:-1], diffs[1:]))
+                steps = np.unique(np.concatenate(steps))
+                steps = steps[(steps >= minStep) & (steps <= maxStep)]
+                if self._discard_first_point:
+                    steps = steps[fi - steps >= fMin]
+
+                if len(steps) > 0:
+                    # All candidates at once: (candidate, uncovered point)
+                    pos = rel[np.newaxis, :] // steps[:, np.newaxis]
+                    on = (pos * steps[:, np.newaxis] == rel[np.newaxis, :]) & (pos < wndPoints)
+                    count = on.sum(axis = 1)
+                    span = np.where(on, pos, 0).max(axis = 1) + 1
+                    # Most covered points first, then fewest measured points
+                    iBest = int(np.lexsort((span, -count))[0])
+                    if count[iBest] > 0:
+                        sel = on[iBest]
+                        best = ( int(steps[iBest]), np.concatenate(([i], uncovered[sel])), np.concatenate(([0], pos[iBest][sel])) )
+
+            if best is None:
+                # Isolated point, the step size is irrelevant
+                best = ( minStep, np.asarray([ i ]), np.asarray([ 0 ]) )
+
+            step, members, pos = best
+            dstMap = np.full(int(pos[-1]) + 1, -1, dtype = np.int64)
+            dstMap[pos] = members
+            covered[members] = True
+            segments.append(( fi, step, len(dstMap), dstMap ))
+
+            while (i < n) and covered[i]:
+                i = i + 1
+
+        return segments
+
+    def _set_sweep_plan(self, freqs, bandIdx):
+        import numpy as np
+
+        if not self._use_numpy:
+            raise ValueError("Sweep plans require numpy")
+
+        wndPoints = 100 if self._discard_first_point else 101
+        minStep, maxStep = int(self._frequencyStepRange[0]), int(self._frequencyStepRange[1])
+
+        if (freqs[0] < self._frequencyRange[0]) or (freqs[-1] > self._frequencyRange[1]):
+            raise ValueError(f"Frequencies have to be in range {self._frequencyRange[0]} to {self._frequencyRange[1]} Hz")
+
+        d = np.diff(freqs)
+        if np.any(d < minStep):
+            raise ValueError(f"Frequencies have to be spaced at least {minStep} Hz apart")
+
+        # Compile with both strategies and keep the valid plan with fewer
+        # segments (and fewer measured points on ties). Segments are (start,
+        # step, points, dstMap) with dstMap mapping every grid point of the
+        # window to its index in the output trace (-1 for grid points that
+        # have not been requested)
+        fMin = self._frequencyRange[0]
+        segments = None
+        for compiler in [ self._compile_sweep_runs, self._compile_sweep_grids ]:
+            candidate = compiler(freqs, d, wndPoints, minStep, maxStep)
+            invalid = self._discard_first_point and any([ seg[0] - seg[1] < fMin for seg in candidate ])
+            key = ( invalid, len(candidate), sum([ seg[2] for seg in candidate ]) )
+            if (segments is None) or (key < bestKey):
+                segments, bestKey = candidate, key
+
+        if self._discard_first_point:
+            for seg in segments:
+                if seg[0] - seg[1] < fMin:
+                    raise ValueError(f"Supported frequency range is above {fMin + seg[1]} Hz when discarding the first point")
+
+        self._sweepPlan = {
+            "freq" : freqs.astype(float),
+            "band" : bandIdx,
+            "segments" : segments
+        }
+
+        return len(segments)
+
+    def _query_sweep_plan(self, segmentCallback = None):
+        # Acquire all segments of the configured sweep plan. Returns one
+        # trace with the same fields as _query_trace and additionally the
+        # band index of every point. The optional segmentCallback is called
+        # as segmentCallback(iSegment, freqBaseIndex, newpkgdata) similar to
+        # _query_trace. Since a segment may cover points that are not
+        # adjacent in the output newpkgdata additionally contains "index",
+        # the output indices of its points, and freqBaseIndex is the first
+        # of them.
+
+        if self._port is None:
+            raise CommunicationError_NotConnected("Device it not connected, failed to query data")
+        if self._sweepPlan is None:
+            raise ValueError("No sweep plan has been configured")
+
+        import numpy as np
+
+        nPoints = len(self._sweepPlan["freq"])
+        pkgdata = {
+            "freq" : self._sweepPlan["freq"].copy(),
+            "band" : self._sweepPlan["band"].copy(),
+
+            "fwd0" : np.full((nPoints), np.nan, dtype = complex),
+            "rev0" : np.full((nPoints), np.nan, dtype = complex),
+            "rev1" : np.full((nPoints), np.nan, dtype = complex)
+        }
+
+        for iSegment, ( start, step, count, dstMap ) in enumerate(self._sweepPlan["segments"]):
+            realSweepPoints = count
+            if self._discard_first_point:
+                realSweepPoints = realSweepPoints + 1
+                start = start - step
+
+            records = self._fifo_decode(self._acquire_segment(start, step, realSweepPoints, 1))
+            freqIndex = records["freqIndex"]
+            if self._discard_first_point:
+                freqIndex = freqIndex - 1
+            valid = (freqIndex >= 0) & (freqIndex < count)
+            valid[valid] = dstMap[freqIndex[valid]] >= 0
+            dst = dstMap[freqIndex[valid]]
+            for fld in [ "fwd0", "rev0", "rev1" ]:
+                pkgdata[fld][dst] = records[fld][valid]
+
+            if segmentCallback is not None:
+                idx = dstMap[dstMap >= 0]
+                newpkgdata = { "index" : idx, "freq" : pkgdata["freq"][idx] }
+                for fld in [ "fwd0", "rev0", "rev1" ]:
+                    newpkgdata[fld] = pkgdata[fld][idx]
+                newpkgdata["s00raw"] = newpkgdata["rev0"] / newpkgdata["fwd0"]
+                newpkgdata["s01raw"] = newpkgdata["rev1"] / newpkgdata["fwd0"]
+                segmentCallback(iSegment, int(idx[0]), newpkgdata)
+
+        self._derive_quantities(pkgdata)
+
+        return pkgdata
+
+    # Pipelined acquisition
+    #
+    # A reader thread programs each sweep window, issues all FIFO read
+    # requests of the window at once and hands the received raw records to
+    # the calling thread which decodes them (vectorized) into preallocated
+    # output arrays. As soon as a window has been drained the reader
+    # programs the next one so the device measures while the host decodes.
+
+    def _query_trace_pipelined(self, segmentCallback = None, queueDepth = 8, prefetch = 1):
+        # Same result as _query_trace (requires numpy). The segmentCallback is
+        # called from the calling thread as segmentCallback(iSegment, freqBaseIndex, newpkgdata).
+        #
+        # The reader thread queues the register writes, FIFO clear and FIFO
+        # read requests of the next prefetch windows right behind the read
+        # requests of the current window before receiving its response. The
+        # device processes commands in order so it starts the next window as
+        # soon as the current one has been transferred instead of waiting for
+        # the host to receive the data and issue the next window. prefetch = 0
+        # issues every window only after the previous one has been received.
+        # On errors the queued windows are discarded by the resync and issued
+        # again.
+        #
+        # Per stage statistics are stored in self._pipelineStats:
+        #
+        #   wall               Total duration of the sweep in seconds
+        #   acquireBusy        Time the reader spent transferring data
+        #   acquireOccupancy   acquireBusy / wall
+        #   acquireStalled     Time the reader waited for a free queue slot
+        #   segmentTime        acquireBusy / segments, compare against a sweep
+        #                      with prefetch = 0 to see the gain of prefetching
+        #   prefetch           Number of windows queued ahead
+        #   prefetched         Number of windows that have been requested
+        #                      before the previous response has been received
+        #   retries            Number of repeated windows
+        #   decodeBusy         Time spent decoding and in the segment callback
+        #   decodeOccupancy    decodeBusy / wall
+        #   queueMax           Maximum number of buffered segments
+        #   segments           Number of segments
+
+        if self._port is None:
+            raise CommunicationError_NotConnected("Device it not connected, failed to query data")
+        if not self._use_numpy:
+            raise ValueError("Pipelined acquisition requires numpy")
+        if (int(prefetch) != prefetch) or (prefetch < 0):
+            raise ValueError("Prefetch depth has to be a non negative integer")
+
+        import numpy as np
+
+        nSegments = self._sweepSegments
+        nPoints = self._sweepPoints * nSegments
+        realSweepPoints = self._sweepPoints + (1 if self._discard_first_point else 0)
+        frequencies = np.asarray(self._frequencies)
+
+        segmentStarts = []
+        currentStart = self._sweepStartHz
+        for iSegment in range(nSegments):
+            segmentStarts.append(currentStart)
+            currentStart = currentStart + self._sweepStepHz * 101
+            if self._discard_first_point:
+                currentStart = currentStart - self._sweepStepHz
+
+        pkgdata = {
+            "freq" : np.full((nPoints), np.nan),
+
+            "fwd0" : np.full((nPoints), np.nan, dtype = complex),
+            "rev0" : np.full((nPoints), np.nan, dtype = complex),
+            "rev1" : np.full((nPoints), np.nan, dtype = complex)
+        }
+
+        buffers = queue.Queue(maxsize = max(int(queueDepth), 1))
+        stop = threading.Event()
+        stats = {
+            "acquireBusy" : 0.0, "acquireStalled" : 0.0, "decodeBusy" : 0.0, "queueMax" : 0, "segments" : nSegments,
+            "prefetch" : int(prefetch), "prefetched" : 0, "retries" : 0
+        }
+
+        def reader():
+            try:
+                # Windows [iSegment, issued) have been requested and not yet received
+                issued = 0
+                iSegment = 0
+                iTry = 0
+                while iSegment < nSegments:
+                    if stop.is_set():
+                        # Drop responses of windows that are still in flight
+                        if issued > iSegment:
+                            self._resync()
+                        return
+                    t = time.perf_counter()
+                    try:
+                        if iTry > 0:
+                            self._resync()
+                            issued = iSegment
+
+                        while issued < min(iSegment + 1 + int(prefetch), nSegments):
+                            self._port.write(self._segment_commands(segmentStarts[issued], self._sweepStepHz, realSweepPoints, self._valuesPerFrequency))
+                            if issued > iSegment:
+                                stats["prefetched"] += 1
+                            issued = issued + 1
+
+                        alldata = self._segment_receive(realSweepPoints, self._valuesPerFrequency)
+                    except (CommunicationError_Timeout, CommunicationError_ProtocolViolation) as e:
+                        stats["acquireBusy"] += time.perf_counter() - t
+                        if iTry >= self._segmentRetries:
+                            raise
+                        iTry = iTry + 1
+                        stats["retries"] += 1
+                        self._logger.warning(f"Segment at {segmentStarts[iSegment]} Hz failed ({e}), retrying ({iTry} of {self._segmentRetries})")
+                        continue
+
+                    iTry = 0
+                    t2 = time.perf_counter()
+                    stats["acquireBusy"] += t2 - t
+                    buffers.put(( iSegment, alldata ))
+                    stats["acquireStalled"] += time.perf_counter() - t2
+                    stats["queueMax"] = max(stats["queueMax"], buffers.qsize())
+                    iSegment = iSegment + 1
+            except Exception as e:
+                buffers.put(( None, e ))
+
+        tStart = time.perf_counter()
+        readerThread = threading.Thread(target = reader, daemon = True)
+        readerThread.start()
+
+        try:
+            for _ in range(nSegments):
+                iSegment, alldata = buffers.get()
+                if iSegment is None:
+                    raise alldata
+
+                t = time.perf_counter()
+                records = self._fifo_decode(alldata)
+                freqIndex = records["freqIndex"]
+                if self._discard_first_point:
+                    freqIndex = freqIndex - 1
+                valid = (freqIndex >= 0) & (freqIndex < self._sweepPoints)
+                freqBaseIndex = iSegment * self._sweepPoints
+                dst = freqBaseIndex + freqIndex[valid]
+
+                pkgdata["freq"][dst] = frequencies[dst]
+                for fld in [ "fwd0", "rev0", "rev1" ]:
+                    pkgdata[fld][dst] = records[fld][valid]
+
+                if segmentCallback is not None:
+                    sl = slice(freqBaseIndex, freqBaseIndex + self._sweepPoints)
+                    newpkgdata = { }
+                    for fld in [ "freq", "fwd0", "rev0", "rev1" ]:
+                        newpkgdata[fld] = pkgdata[fld][sl]
+                    newpkgdata["s00raw"] = newpkgdata["rev0"] / newpkgdata["fwd0"]
+                    newpkgdata["s01raw"] = newpkgdata["rev1"] / newpkgdata["fwd0"]
+                    segmentCallback(iSegment, freqBaseIndex, newpkgdata)
+
+                stats["decodeBusy"] += time.perf_counter() - t
+        finally:
+            stop.set()
+            # Unblock the reader in case it's waiting for a free slot
+            while readerThread.is_alive():
+                try:
+                    buffers.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+            readerThread.join()
+
+        t = time.perf_counter()
+        self._derive_quantities(pkgdata)
+        stats["decodeBusy"] += time.perf_counter() - t
+
+        stats["wall"] = time.perf_counter() - tStart
+        stats["acquireOccupancy"] = stats["acquireBusy"] / stats["wall"] if stats["wall"] > 0 else 0.0
+        stats["decodeOccupancy"] = stats["decodeBusy"] / stats["wall"] if stats["wall"] > 0 else 0.0
+        stats["segmentTime"] = stats["acquireBusy"] / nSegments if nSegments > 0 else 0.0
+        self._pipelineStats = stats
+
+        return pkgdata
+
 
 if __name__ == "__main__":
     with NanoVNAV2("/dev/ttyU0", debug = True, useNumpy = True) as vna:
@@ -559,6 +1356,7 @@ if __name__ == "__main__":
 
         import numpy as np
         import matplotlib.pyplot as plt
+        from pynanovnav2.decimate import plotDecimated
 
 #        from ssg3021x.ssg3021x import SSG3021X
 #        with SSG3021X("10.4.1.11") as ssg:
@@ -625,16 +1423,16 @@ if __name__ == "__main__":
         data = vna._query_trace()
 
         fig, ax = plt.subplots(2, figsize=(6.4*1, 4.8*2))
-        ax[0].plot(data["freq"]/1e6, data["s00rawdbm"], label = "S00")
-        ax[0].plot(data["freq"]/1e6, data["s01rawdbm"], label = "S01")
+        plotDecimated(ax[0], data["freq"]/1e6, data["s00rawdbm"], label = "S00")
+        plotDecimated(ax[0], data["freq"]/1e6, data["s01rawdbm"], label = "S01")
         ax[0].set_xlabel("Frequency [MHz]")
         ax[0].set_ylabel("Power [dB]")
         ax[0].set_title("Kicker")
         ax[0].grid()
         ax[0].legend()
 
-        ax[1].plot(data["freq"]/1e6, data["s00rawphase"], label = "Phase S00")
-        ax[1].plot(data["freq"]/1e6, data["s01rawphase"], label = "Phase S01")
+        plotDecimated(ax[1], data["freq"]/1e6, data["s00rawphase"], label = "Phase S00")
+        plotDecimated(ax[1], data["freq"]/1e6, data["s01rawphase"], label = "Phase S01")
         ax[1].set_xlabel("Frequency [MHz]")
         ax[1].set_ylabel("Phase [rad]")
         ax[1].grid()
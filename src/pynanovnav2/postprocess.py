@@ -0,0 +1,171 @@
+# Parallel post processing of traces
+#
+# After acquisition the raw S parameters, their magnitude in dB and their
+# phase are derived from the fwd0, rev0 and rev1 arrays. For multi million
+# point traces every one of those steps is a full pass over memory. The
+# TracePostProcessor splits the trace into chunks and distributes them over
+# a thread pool. All work is done by numpy ufuncs writing into preallocated
+# output arrays which release the GIL so the chunks really run in parallel.
+#
+# In fused mode (default) all steps are applied to one chunk before moving
+# to the next one so the chunk stays in cache. Without fusing every step
+# runs as a separate (chunked, parallel) pass over the whole trace.
+#
+# Corrections (for example calibration) can be supplied as callables
+# correction(pkgdata, sl) that modify pkgdata["s00raw"][sl] and
+# pkgdata["s01raw"][sl] in place. They're applied after the raw S
+# parameters have been calculated and before magnitude and phase.
+#
+# Requires numpy
+
+import numpy as np
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class TracePostProcessor:
+    def __init__(
+        self,
+
+        threads = None,
+        chunkSize = 65536,
+        fused = True,
+        corrections = None
+    ):
+        if threads is None:
+            threads = os.cpu_count() or 1
+        if (int(threads) != threads) or (threads < 1):
+            raise ValueError("Number of threads has to be a positive integer")
+        if (int(chunkSize) != chunkSize) or (chunkSize < 1):
+            raise ValueError("Chunk size has to be a positive integer")
+
+        self._threads = int(threads)
+        self._chunkSize = int(chunkSize)
+        self._fused = fused
+        self._corrections = list(corrections) if corrections is not None else []
+        self._pool = ThreadPoolExecutor(max_workers = self._threads) if self._threads > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _map(self, fn, slices):
+        # Division by zero (zero fwd0, zero magnitudes) yields inf and nan
+        # without warnings. The error state is thread local so it has to be
+        # set inside the worker
+        def chunk(sl):
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                fn(sl)
+
+        if self._pool is None:
+            for sl in slices:
+                chunk(sl)
+        else:
+            # list() propagates exceptions raised by any chunk
+            list(self._pool.map(chunk, slices))
+
+    def process(self, pkgdata):
+        # Calculate s00raw, s01raw, s00rawdbm, s01rawdbm, s00rawphase and
+        # s01rawphase from fwd0, rev0 and rev1 of pkgdata (in place).
+        # Returns pkgdata
+
+        fwd0 = np.asarray(pkgdata["fwd0"])
+        nPoints = fwd0.shape[0]
+        for name in [ "s00raw", "s01raw" ]:
+            pkgdata[name] = np.empty(nPoints, dtype = complex)
+            pkgdata[name + "dbm"] = np.empty(nPoints)
+            pkgdata[name + "phase"] = np.empty(nPoints)
+
+        def sParameters(sl):
+            np.divide(pkgdata["rev0"][sl], fwd0[sl], out = pkgdata["s00raw"][sl])
+            np.divide(pkgdata["rev1"][sl], fwd0[sl], out = pkgdata["s01raw"][sl])
+
+        def corrections(sl):
+            for corr in self._corrections:
+                corr(pkgdata, sl)
+
+        def magnitudes(sl):
+            for name in [ "s00raw", "s01raw" ]:
+                dbm = pkgdata[name + "dbm"][sl]
+                np.absolute(pkgdata[name][sl], out = dbm)
+                np.log10(dbm, out = dbm)
+                np.multiply(dbm, 20, out = dbm)
+
+        def phases(sl):
+            for name in [ "s00raw", "s01raw" ]:
+                s = pkgdata[name][sl]
+                np.arctan2(s.imag, s.real, out = pkgdata[name + "phase"][sl])
+
+        steps = [ sParameters ]
+        if len(self._corrections) > 0:
+            steps.append(corrections)
+        steps = steps + [ magnitudes, phases ]
+
+        slices = [ slice(i, min(i + self._chunkSize, nPoints)) for i in range(0, nPoints, self._chunkSize) ]
+
+        if self._fused:
+            def fusedChunk(sl):
+                for step in steps:
+                    step(sl)
+            self._map(fusedChunk, slices)
+        else:
+            for step in steps:
+                self._map(step, slices)
+
+        return pkgdata
+
+def benchmark(nPoints = 4350000, threadCounts = None, chunkSize = 65536, repeat = 3):
+    # Measure post processing time of a synthetic trace for different
+    # thread counts in fused and unfused mode. Returns a list of
+    # (threads, fused, seconds, speedup) tuples, the speedup is relative to
+    # the unchunked single threaded numpy implementation.
+
+    if threadCounts is None:
+        threadCounts = sorted(set([ 1, 2, 4, 8, os.cpu_count() or 1 ]))
+        threadCounts = [ t for t in threadCounts if t <= (os.cpu_count() or 1) ]
+
+    rng = np.random.default_rng(0)
+    pkgdata = { }
+    for fld in [ "fwd0", "rev0", "rev1" ]:
+        pkgdata[fld] = rng.standard_normal(nPoints) + 1j * rng.standard_normal(nPoints)
+
+    def reference():
+        s00raw = pkgdata["rev0"] / pkgdata["fwd0"]
+        s01raw = pkgdata["rev1"] / pkgdata["fwd0"]
+        np.log10(np.absolute(s00raw)) * 20
+        np.log10(np.absolute(s01raw)) * 20
+        np.angle(s00raw)
+        np.angle(s01raw)
+
+    def timed(fn):
+        best = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            fn()
+            t = time.perf_counter() - t
+            best = t if (best is None) or (t < best) else best
+        return best
+
+    tRef = timed(reference)
+    results = [ ( 1, None, tRef, 1.0 ) ]
+    for threads in threadCounts:
+        for fused in [ False, True ]:
+            with TracePostProcessor(threads = threads, chunkSize = chunkSize, fused = fused) as pp:
+                t = timed(lambda: pp.process(pkgdata))
+            results.append(( threads, fused, t, tRef / t ))
+
+    return results
+
+if __name__ == "__main__":
+    print(f"{'Threads':>8} {'Mode':>10} {'Time [s]':>10} {'Speedup':>8}")
+    for threads, fused, t, speedup in benchmark():
+        mode = "reference" if fused is None else ("fused" if fused else "unfused")
+        print(f"{threads:>8} {mode:>10} {t:>10.4f} {speedup:>8.2f}")
@@ -1,4 +1,5 @@
 from pynanovnav2.nanovnav2 import NanoVNAV2
+from pynanovnav2.decimate import plotDecimated
 
 import numpy as np
 
@@ -21,6 +22,7 @@ def _parseArguments():
     ap.add_argument('--plottitle', type=str, required=False, default="NanoVNA v2", help="Title for the plot")
     ap.add_argument('--label00', type=str, required=False, default="S00", help="Label for the S00 parameter")
     ap.add_argument('--label01', type=str, required=False, default="S01", help="Label for the S01 parameter")
+    ap.add_argument('--plotpoints', type=int, required=False, default=None, help="Number of points per plotted trace after min/max decimation (default: two per pixel, 0 disables decimation)")
 
     ap.add_argument('--npz', type=str, required=False, default=None, help="Dump data into supplied NPZ file")
 
@@ -45,6 +47,9 @@ def main():
     if (args.step < 1e3) or (args.step > 10e6):
         print("Step size has to be in range of 1 kHz to 10 MHz")
         sys.exit(1)
+    if (args.plotpoints is not None) and (args.plotpoints != 0) and (args.plotpoints < 2):
+        print("Number of plotted points has to be at least 2 (or 0 to disable decimation)")
+        sys.exit(1)
 
     plotting = False
     if args.plot != None:
@@ -85,9 +90,9 @@ def main():
                 fig, ax = plt.subplots(2, figsize=(6.4, 4.8*2))
 
                 if args.s00:
-                    ax[0].plot(data["freq"]/1e6, data["s00rawdbm"], label=args.label00)
+                    plotDecimated(ax[0], data["freq"]/1e6, data["s00rawdbm"], nPoints=args.plotpoints, label=args.label00)
                 if args.s01:
-                    ax[0].plot(data["freq"]/1e6, data["s01rawdbm"], label=args.label01)
+                    plotDecimated(ax[0], data["freq"]/1e6, data["s01rawdbm"], nPoints=args.plotpoints, label=args.label01)
                 ax[0].set_xlabel("Frequency [MHz]")
                 ax[0].set_ylabel("Power [dB]")
                 ax[0].set_title(args.plottitle)
@@ -95,9 +100,9 @@ def main():
                 ax[0].legend()
 
                 if args.s00:
-                    ax[1].plot(data["freq"]/1e6, data["s00rawphase"], label=args.label00)
+                    plotDecimated(ax[1], data["freq"]/1e6, data["s00rawphase"], nPoints=args.plotpoints, label=args.label00)
                 if args.s01:
-                    ax[1].plot(data["freq"]/1e6, data["s01rawphase"], label=args.label01)
+                    plotDecimated(ax[1], data["freq"]/1e6, data["s01rawphase"], nPoints=args.plotpoints, label=args.label01)
                 ax[1].set_xlabel("Frequency [MHz]")
                 ax[1].set_ylabel("Phase [rad]")
                 ax[1].grid()
@@ -106,9 +111,9 @@ def main():
                 fig, ax = plt.subplots()
 
                 if args.s00:
-                    ax.plot(data["freq"]/1e6, data["s00rawdbm"], label=args.label00)
+                    plotDecimated(ax, data["freq"]/1e6, data["s00rawdbm"], nPoints=args.plotpoints, label=args.label00)
                 if args.s01:
-                    ax.plot(data["freq"]/1e6, data["s01rawdbm"], label=args.label01)
+                    plotDecimated(ax, data["freq"]/1e6, data["s01rawdbm"], nPoints=args.plotpoints, label=args.label01)
                 ax.set_xlabel("Frequency [MHz]")
                 ax.set_ylabel("Power [dB]")
                 ax.set_title(args.plottitle)